@@ -19,7 +19,9 @@ setuptools.setup(
         'Development Status :: 4 - Beta',
         'License :: OSI Approved :: MIT License',
         'Operating System :: OS Independent',
-        'Programming Language :: Python :: 2.7',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.11',
         'Topic :: Software Development :: Libraries :: Python Modules',
         'Topic :: System :: Networking :: Monitoring',
     ],
@@ -27,9 +29,7 @@ setuptools.setup(
     packages=setuptools.find_packages('src'),
     package_dir={'': 'src'},
     include_package_data=True,
-    install_requires=[
-        'pyev',
-    ],
+    python_requires='>=3.11',
     setup_requires=['pytest-runner'],
     tests_require=['pytest'],
     zip_safe=True,
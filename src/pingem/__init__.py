@@ -1 +1 @@
-from pinger import Pinger
+from pingem.pinger import Pinger
@@ -1,42 +1,48 @@
-# -*- coding: utf-8 -*-
-
 # Copyright (c) 2017 Sander Ernes.
 # License: MIT, see LICENSE for more details.
 
 # ICMP packet construction, parsing, checksumming blatantly taken from
 # python-ping
 
-import array
+import asyncio
+import collections
+import itertools
 import socket
 import struct
 import sys
 import time
 
-import pyev
-
 ICMP = socket.getprotobyname('icmp')
+IP_HEADER_SIZE = 20
 ICMP_ECHO_REPLY = 0
 ICMP_ECHO_REQUEST = 8
 
 ICMP_HEADER_FORMAT = '!BBHHH'  # type, code, checksum, id, seq
-ICMP_HEADER_SIZE = struct.calcsize(ICMP_HEADER_FORMAT)
-ICMP_TIMESTAMP_SIZE = struct.calcsize('d')
+ICMP_HEADER = struct.Struct(ICMP_HEADER_FORMAT)
+ICMP_HEADER_SIZE = ICMP_HEADER.size
+# Header, timestamp and a copy of the id, which the kernel replaces in the
+# header for datagram ICMP sockets
+ICMP_ECHO = struct.Struct(ICMP_HEADER_FORMAT + 'dH')
+ICMP_ECHO_FIELD_WORDS = struct.Struct('!7H')  # id, seq, timestamp, id
 
+RECEIVE_BATCH_SIZE = 64  # max number of replies read per socket wakeup
 
-class Pinger(object):
+
+class Pinger:
     """Ping multiple hosts in parallel
 
     Args:
         callback (callable): a callback taking (host, rtt) as arguments
         timeout (float): number of seconds to wait for a reply
         packet_limit (int): number of concurrently 'active' packets
-        packet_size (int): ICMP packet size
+        packet_size (int): ICMP packet size, at least ICMP_ECHO.size (18)
+            bytes
 
     Sample usage::
 
         >>> from pingem import Pinger
         >>> def print_reply(host, rtt):
-        ...     print host, rtt
+        ...     print(host, rtt)
         ...
         >>> pinger = Pinger(print_reply)
         >>> pinger.add_host('127.0.0.1')
@@ -48,26 +54,48 @@ class Pinger(object):
 
     def __init__(self, callback=None, timeout=1.0,
                  packet_limit=1000, packet_size=64):
+        if packet_size < ICMP_ECHO.size:
+            raise ValueError(
+                'packet_size must be at least %d bytes' % ICMP_ECHO.size
+            )
+
         self.callback = callback
         self._timeout = timeout
-        self._last_packet_timestamp = 0
         self._packet_limit = packet_limit
-        self._packet_size = packet_size
+        self._packet = create_icmp_echo_request_buffer(packet_size)
+        self._packet_sum = ones_complement_sum(self._packet)
+        self._receive_buffer = bytearray(1024)
+        self._receive_view = memoryview(self._receive_buffer)
 
         self._hosts = []
 
-        self._id = 0
+        self._ids = itertools.count()
         self._seq = 0
-        self._pending_hosts = []
-        self._packets = {}
-
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, ICMP)
-
-        self._loop = pyev.Loop()
-        self._io_watcher = self._loop.io(
-            self._socket, pyev.EV_READ, self._on_receive
-        )
-        self._idle_watcher = self._loop.idle(self._on_idle)
+        self._packets = {}  # packet id -> future for the reply's rtt
+        self._deadlines = collections.deque()  # (deadline, reply future)
+        self._timeout_handle = None
+
+        self._dgram = False
+        if sys.platform.startswith('linux'):
+            # Linux datagram ICMP sockets need no privileges where allowed
+            # (see net.ipv4.ping_group_range), the kernel fills in the
+            # checksum and strips the IP header from replies; other systems
+            # differ (e.g. Darwin keeps the IP header), so use raw sockets
+            # there
+            try:
+                self._socket = socket.socket(
+                    socket.AF_INET, socket.SOCK_DGRAM, ICMP
+                )
+                self._dgram = True
+            except OSError:
+                pass
+        if not self._dgram:
+            self._socket = socket.socket(
+                socket.AF_INET, socket.SOCK_RAW, ICMP
+            )
+        self._socket.setblocking(False)
+        # Datagram ICMP sockets receive replies without the IP header
+        self._reply_offset = 0 if self._dgram else IP_HEADER_SIZE
 
     @property
     def callback(self):
@@ -90,87 +118,161 @@ class Pinger(object):
     def ping(self):
         """Ping all added hosts, calling back with the results.
         """
-        self._pending_hosts = self._hosts[:]
         self._seq = (self._seq + 1) & 0xFFFF  # increment & truncate to 16 bits
 
-        self._idle_watcher.start()
-        self._io_watcher.start()
-        self._loop.start()
+        asyncio.run(self._ping_hosts(self._hosts[:]))
 
-    def _on_idle(self, watcher, revents):
-        if self._pending_hosts:
-            if not self._try_send():
-                self._try_removing_a_timed_out_packet()
-        else:
-            if not self._packets or self._have_timed_out():
-                self._loop.stop()
-                self._send_timeouts()
-
-    def _try_removing_a_timed_out_packet(self):
-        now = time.time()
-        for packet_id, packet in self._packets.iteritems():
-            if now - packet['send_time'] > self._timeout:
-                self._callback(packet['dst_addr'], None)
-                del self._packets[packet_id]
-                return
-
-    def _try_send(self):
-        if len(self._packets) < self._packet_limit:
-            self._send(self._pending_hosts.pop())
-            return True
-
-    def _have_timed_out(self):
-        return time.time() - self._last_packet_timestamp > self._timeout
+    async def _ping_hosts(self, hosts):
+        loop = asyncio.get_running_loop()
+        packet_slots = asyncio.Semaphore(self._packet_limit)
 
-    def _send_timeouts(self):
-        for packet in self._packets.itervalues():
-            self._callback(packet['dst_addr'], None)
-        self._packets.clear()
+        addresses = await resolve_hosts(hosts)
+        # Socket addresses for sendto(), built once rather than per packet
+        sockaddrs = {host: (addr, 1) for host, addr in addresses.items()}
 
-    def _send(self, dst_addr):
-        packet_id = self._get_next_packet_id()
-        now = time.time()
-
-        packet = create_icmp_echo_request(
-            packet_id, self._seq, now, size=self._packet_size
-        )
+        loop.add_reader(self._socket.fileno(), self._on_receive)
+        try:
+            await asyncio.gather(*(
+                self._ping_host(host, sockaddrs[host], packet_slots)
+                for host in hosts
+            ))
+        finally:
+            loop.remove_reader(self._socket.fileno())
+            if self._timeout_handle is not None:
+                self._timeout_handle.cancel()
+                self._timeout_handle = None
+            self._packets.clear()
+            self._deadlines.clear()
+
+    async def _ping_host(self, host, sockaddr, packet_slots):
+        loop = asyncio.get_running_loop()
+
+        async with packet_slots:
+            packet_id = next(self._ids) & 0xFFFF  # truncate to 16 bits
+            reply = loop.create_future()
+            self._packets[packet_id] = reply
+
+            fill_icmp_echo_request(
+                self._packet, packet_id, self._seq, time.monotonic(),
+                template_sum=self._packet_sum, with_checksum=not self._dgram
+            )
+
+            try:
+                await self._send(loop, sockaddr)
+
+                # Pick up replies after every send as well, or a burst of
+                # sends can overflow the socket's receive buffer before the
+                # reader gets to run (an empty socket costs just one recv)
+                self._on_receive()
+
+                # Packets are sent in order, so they time out in order as
+                # well - a single timer for the oldest one is enough
+                self._deadlines.append((loop.time() + self._timeout, reply))
+                if self._timeout_handle is None:
+                    self._timeout_handle = loop.call_at(
+                        self._deadlines[0][0], self._on_timeout, loop
+                    )
+
+                rtt = await reply
+            finally:
+                self._packets.pop(packet_id, None)
+
+        self._callback(host, rtt)
+
+    async def _send(self, loop, sockaddr):
+        try:
+            self._socket.sendto(self._packet, sockaddr)
+        except BlockingIOError:
+            # Send a copy, the buffer is reused by the next packet while this
+            # one waits for the socket to become writable
+            await loop.sock_sendto(
+                self._socket, bytes(self._packet), sockaddr
+            )
+
+    def _on_timeout(self, loop):
+        self._timeout_handle = None
+        now = loop.time()
+        while self._deadlines:
+            deadline, reply = self._deadlines[0]
+            if deadline > now:
+                self._timeout_handle = loop.call_at(
+                    deadline, self._on_timeout, loop
+                )
+                return
 
-        self._socket.sendto(packet, (dst_addr, 1))
-        self._packets[packet_id] = {
-            'dst_addr': dst_addr,
-            'send_time': now
-        }
-        self._last_packet_timestamp = now
+            self._deadlines.popleft()
+            if not reply.done():
+                reply.set_result(None)
+
+    def _on_receive(self):
+        # Drain what has queued up on the socket rather than going through
+        # the event loop once per reply
+
+        # Looked up once rather than on every reply
+        recv_into = self._socket.recv_into
+        receive_buffer = self._receive_buffer
+        receive_view = self._receive_view
+        process_reply = self._process_reply
+
+        for _ in range(RECEIVE_BATCH_SIZE):
+            try:
+                # The sender's address is not needed, the packet id in the
+                # reply identifies the host
+                nbytes = recv_into(receive_buffer)
+            except BlockingIOError:
+                return
 
-    def _get_next_packet_id(self):
-        packet_id = self._id
-        self._id = (self._id + 1) & 0xFFFF  # increment & truncate to 16 bits
-        return packet_id
+            process_reply(receive_view[:nbytes])
 
-    def _on_receive(self, watcher, revents):
-        received_packet, addr = self._socket.recvfrom(1024)
+    def _process_reply(self, received_packet):
         try:
-            packet_id, seq, time_sent = parse_icmp_echo_reply(received_packet)
+            packet_id, seq, time_sent = parse_icmp_echo_reply(
+                received_packet, self._reply_offset
+            )
         except InvalidIcmpPacketType:
             return
 
         if seq != self._seq:
             return
 
-        try:
-            packet = self._packets.pop(packet_id)
-        except KeyError:
+        reply = self._packets.pop(packet_id, None)
+        if reply is None or reply.done():
             return
 
-        rtt = time.time() - time_sent
-
-        self._callback(packet['dst_addr'], rtt)
+        reply.set_result(time.monotonic() - time_sent)
 
 
 class InvalidIcmpPacketType(Exception):
     pass
 
 
+async def resolve_hosts(hosts):
+    """Resolve `hosts` to IPv4 addresses, looking up all names concurrently.
+
+    Returns:
+        Dict mapping each host to its address.
+    """
+    loop = asyncio.get_running_loop()
+    addresses = {}
+    names = []
+    for host in hosts:
+        try:
+            socket.inet_pton(socket.AF_INET, host)
+        except OSError:
+            names.append(host)
+        else:
+            addresses[host] = host
+
+    names = list(set(names))
+    results = await asyncio.gather(*(
+        loop.getaddrinfo(name, None, family=socket.AF_INET) for name in names
+    ))
+    for name, addrinfo in zip(names, results):
+        addresses[name] = addrinfo[0][4][0]
+
+    return addresses
+
+
 def create_icmp_echo_request(id_, seq, timestamp, size=64):
     """Create an ICMP echo request packet
 
@@ -180,26 +282,69 @@ def create_icmp_echo_request(id_, seq, timestamp, size=64):
         timestamp (int): timestamp to include in the packet
         size (int): packet size
     """
-    payload_psize = size - ICMP_HEADER_SIZE
-    checksum = 0
+    packet = create_icmp_echo_request_buffer(size)
+    fill_icmp_echo_request(packet, id_, seq, timestamp)
+
+    return bytes(packet)
+
+
+def create_icmp_echo_request_buffer(size=64):
+    """Create a reusable buffer for ICMP echo requests of `size` bytes.
+
+    The payload padding is written once; fill_icmp_echo_request() only
+    updates the header and timestamp. Id, seq, timestamp and checksum are
+    left zeroed, so ones_complement_sum() of a fresh buffer can be used as
+    `template_sum` for fill_icmp_echo_request().
+    """
+    packet = bytearray(size)
+    ICMP_ECHO.pack_into(packet, 0, ICMP_ECHO_REQUEST, 0, 0, 0, 0, 0.0, 0)
+    packet[ICMP_ECHO.size:] = (size - ICMP_ECHO.size) * b'Q'
+
+    return packet
 
-    header = struct.pack(
-        ICMP_HEADER_FORMAT, ICMP_ECHO_REQUEST, 0, checksum, id_, seq
-    )
-    payload = (payload_psize - ICMP_TIMESTAMP_SIZE) * 'Q'
-    payload = struct.pack('d', timestamp) + payload
 
-    checksum = calculate_checksum(header + payload)
+def fill_icmp_echo_request(packet, id_, seq, timestamp, template_sum=None,
+                           with_checksum=True):
+    """Fill in the header and timestamp of an ICMP echo request in place.
 
-    header = struct.pack(
-        ICMP_HEADER_FORMAT, ICMP_ECHO_REQUEST, 0, checksum, id_, seq
+    Args:
+        packet (bytearray): buffer from create_icmp_echo_request_buffer()
+        id_ (int): packet id
+        seq (int): sequence id
+        timestamp (int): timestamp to include in the packet
+        template_sum (int): ones' complement sum of a fresh buffer of the
+            same size; if given, the checksum is updated from it instead of
+            summing the whole packet
+        with_checksum (bool): whether to calculate the checksum at all;
+            the kernel does it for datagram ICMP sockets
+    """
+    ICMP_ECHO.pack_into(
+        packet, 0, ICMP_ECHO_REQUEST, 0, 0, id_, seq, timestamp, id_
     )
 
-    return header + payload
+    if not with_checksum:
+        return
+
+    if template_sum is None:
+        checksum = calculate_checksum(packet)
+    else:
+        # The sum is linear, so only the words that differ from the template
+        # have to be added to it
+        val = template_sum + sum(
+            ICMP_ECHO_FIELD_WORDS.unpack_from(packet, 4)
+        )
+        checksum = ~_fold_ones_complement_sum(val) & 0xffff
 
+    ICMP_HEADER.pack_into(packet, 0, ICMP_ECHO_REQUEST, 0, checksum, id_, seq)
 
-def parse_icmp_echo_reply(packet):
-    """Parse echo reply from a **raw** ICMP `packet`.
+
+def parse_icmp_echo_reply(packet, offset=IP_HEADER_SIZE):
+    """Parse echo reply from an ICMP `packet`.
+
+    Args:
+        packet (bytes): packet as received from the ICMP socket
+        offset (int): where the ICMP header starts - after the IP header for
+            raw sockets, 0 for datagram ICMP sockets
 
     Raise:
         InvalidIcmpPacketType: if the packet is not an ICMP echo reply.
@@ -207,35 +352,43 @@ def parse_icmp_echo_reply(packet):
     Returns:
         Tuple of (packet_id, sequcene_id, timestamp).
     """
-    type_, code, checksum, id_, seq = struct.unpack(
-        ICMP_HEADER_FORMAT, packet[20:28]
+    if len(packet) < offset + ICMP_ECHO.size:
+        raise InvalidIcmpPacketType('Packet is too short for our echo reply')
+
+    type_, code, checksum, id_, seq, timestamp, packet_id = (
+        ICMP_ECHO.unpack_from(packet, offset)
     )
 
     if type_ != ICMP_ECHO_REPLY:
         raise InvalidIcmpPacketType('Packet is not ICMP echo reply')
 
-    timestamp = struct.unpack('d', packet[28:28 + ICMP_TIMESTAMP_SIZE])[0]
-
-    return id_, seq, timestamp
+    # The id in the header may have been replaced by the kernel
+    return packet_id, seq, timestamp
 
 
 def calculate_checksum(source_string):
-    if len(source_string) % 2:
-        source_string += '\x00'
+    val = ones_complement_sum(source_string)
 
-    converted = array.array('H', source_string)
+    answer = ~val & 0xffff                # Invert and truncate to 16 bits
+
+    return answer
 
-    if sys.byteorder == 'big':
-        converted.byteswap()
 
-    val = sum(converted)
+def ones_complement_sum(source_string):
+    """Return the 16-bit ones' complement sum of the words in `source_string`.
+    """
+    # The ones' complement sum of the 16-bit (big-endian) words equals the
+    # whole string, read as one big integer, modulo 0xffff (since 2**16 is 1
+    # modulo 0xffff) - this way the summation is done in a single C loop
+    # instead of one Python-level addition per word.
+    val = int.from_bytes(source_string, 'big')
+    if len(source_string) % 2:
+        val <<= 8  # Pad with a zero byte to a whole number of words
 
-    val &= 0xffffffff  # Truncate val to 32 bits (a variance from ping.c, which
-                       # uses signed ints, but overflow is unlikely in ping)
+    return _fold_ones_complement_sum(val)
 
-    val = (val >> 16) + (val & 0xffff)    # Add high 16 bits to low 16 bits
-    val += (val >> 16)                    # Add carry from above (if any)
-    answer = ~val & 0xffff                # Invert and truncate to 16 bits
-    answer = socket.htons(answer)
 
-    return answer
+def _fold_ones_complement_sum(val):
+    if val:
+        val = val % 0xffff or 0xffff  # A non-zero sum never folds to 0
+    return val
@@ -1,5 +1,4 @@
-# -*- coding: utf-8 -*-
-
+import asyncio
 import socket
 import struct
 
@@ -8,22 +7,24 @@ import pytest
 from pingem import pinger as tested
 
 
-def have_raw_socket_capability():
-    try:
-        socket.socket(socket.AF_INET, socket.SOCK_RAW, tested.ICMP)
-    except socket.error:
-        return False
-    else:
-        return True
+def have_icmp_socket_capability():
+    for type_ in (socket.SOCK_DGRAM, socket.SOCK_RAW):
+        try:
+            socket.socket(socket.AF_INET, type_, tested.ICMP).close()
+        except OSError:
+            continue
+        else:
+            return True
+    return False
 
 
 @pytest.mark.skipif(
-    not have_raw_socket_capability(),
-    reason='Cannot open raw sockets'
+    not have_icmp_socket_capability(),
+    reason='Cannot open ICMP sockets'
 )
-class TestPinger(object):
+class TestPinger:
 
-    def setup(self):
+    def setup_method(self):
         self.tested = tested.Pinger(self.callback, timeout=0.1)
         self.replies = {}
 
@@ -65,6 +66,20 @@ class TestPinger(object):
         assert len(self.replies) == 10000
         assert all(self.replies.values())
 
+    def test_ping__thousands_of_hosts_with_large_packets(self):
+        self.tested = tested.Pinger(
+            self.callback, timeout=1.0, packet_size=4000
+        )
+        first_host_int = struct.unpack("!I", socket.inet_aton('127.0.0.1'))[0]
+        for i in range(5000):
+            ip = socket.inet_ntoa(struct.pack("!I", first_host_int + i))
+            self.tested.add_host(ip)
+
+        self.tested.ping()
+
+        assert len(self.replies) == 5000
+        assert all(self.replies.values())
+
     def test_ping__reuses_added_hosts_on_second_call(self):
         self.tested.add_host('127.0.0.1')
         self.tested.ping()
@@ -81,3 +96,94 @@ class TestPinger(object):
         self.tested.ping()
 
         assert not self.replies
+
+    def test_init__accepts_minimum_packet_size(self):
+        tested.Pinger(packet_size=tested.ICMP_ECHO.size)
+
+
+class TestResolveHosts:
+
+    def test_resolve_hosts__keeps_ip_addresses(self):
+        addresses = asyncio.run(tested.resolve_hosts(['127.0.0.1']))
+
+        assert addresses == {'127.0.0.1': '127.0.0.1'}
+
+    def test_resolve_hosts__resolves_names(self):
+        addresses = asyncio.run(tested.resolve_hosts(['localhost']))
+
+        assert addresses == {'localhost': '127.0.0.1'}
+
+
+class TestFillIcmpEchoRequest:
+
+    def test_fill_icmp_echo_request__with_template_sum(self):
+        packet = tested.create_icmp_echo_request_buffer(65)
+        template_sum = tested.ones_complement_sum(packet)
+
+        tested.fill_icmp_echo_request(
+            packet, 0xfffe, 0xabcd, 1234.5, template_sum=template_sum
+        )
+
+        assert bytes(packet) == tested.create_icmp_echo_request(
+            0xfffe, 0xabcd, 1234.5, size=65
+        )
+
+
+class TestPingerInit:
+
+    def test_init__raises_if_packet_size_too_small(self):
+        with pytest.raises(ValueError):
+            tested.Pinger(packet_size=tested.ICMP_ECHO.size - 1)
+
+
+class TestParseIcmpEchoReply:
+
+    def echo_packet(self, type_):
+        packet = bytearray(tested.IP_HEADER_SIZE)
+        packet += tested.create_icmp_echo_request(1, 2, 3.0, size=64)
+        packet[tested.IP_HEADER_SIZE] = type_
+        return bytes(packet)
+
+    def test_parse_icmp_echo_reply__returns_id_seq_and_timestamp(self):
+        packet = self.echo_packet(tested.ICMP_ECHO_REPLY)
+
+        assert tested.parse_icmp_echo_reply(packet) == (1, 2, 3.0)
+
+    def test_parse_icmp_echo_reply__reads_id_from_payload(self):
+        packet = bytearray(self.echo_packet(tested.ICMP_ECHO_REPLY))
+        packet = packet[tested.IP_HEADER_SIZE:]
+        packet[4:6] = b'\xff\xff'  # id in the header replaced by the kernel
+
+        assert tested.parse_icmp_echo_reply(packet, 0) == (1, 2, 3.0)
+
+    def test_parse_icmp_echo_reply__raises_if_not_echo_reply(self):
+        packet = self.echo_packet(tested.ICMP_ECHO_REQUEST)
+
+        with pytest.raises(tested.InvalidIcmpPacketType):
+            tested.parse_icmp_echo_reply(packet)
+
+    def test_parse_icmp_echo_reply__raises_if_too_short(self):
+        packet = self.echo_packet(tested.ICMP_ECHO_REPLY)[:30]
+
+        with pytest.raises(tested.InvalidIcmpPacketType):
+            tested.parse_icmp_echo_reply(packet)
+
+
+class TestCalculateChecksum:
+
+    def test_calculate_checksum__rfc1071_example(self):
+        data = b'\x00\x01\xf2\x03\xf4\xf5\xf6\xf7'
+
+        assert tested.calculate_checksum(data) == 0x220d
+
+    def test_calculate_checksum__pads_odd_length(self):
+        assert (tested.calculate_checksum(b'\x01\x02\x03') ==
+                tested.calculate_checksum(b'\x01\x02\x03\x00'))
+
+    def test_calculate_checksum__of_all_ones_is_zero(self):
+        assert tested.calculate_checksum(b'\xff\xff\xff\xff') == 0
+
+    def test_calculate_checksum__of_checksummed_packet_is_zero(self):
+        packet = tested.create_icmp_echo_request(1, 2, 3.0, size=64)
+
+        assert tested.calculate_checksum(packet) == 0